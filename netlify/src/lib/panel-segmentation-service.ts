@@ -55,6 +55,23 @@ export class PanelSegmentationService {
       }
     }
 
+    // Use a running segmentation server (panel_segmentation.py --serve-http) when configured
+    const serverUrl = process.env.PANEL_SEGMENTATION_URL
+    if (serverUrl) {
+      console.log(`🐍 Using panel segmentation server at ${serverUrl}`)
+      const response = await fetch(`${serverUrl.replace(/\/$/, '')}/segment`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ imageBase64 })
+      })
+      const result = await response.json()
+      if (!response.ok || result.error) {
+        throw new Error(result.error || `Panel segmentation server returned ${response.status}`)
+      }
+      console.log(`✅ Segmentation successful: ${result.panels?.length || 0} panels found`)
+      return result
+    }
+
     // Fallback to Python-based segmentation (local development)
     return new Promise((resolve, reject) => {
       try {
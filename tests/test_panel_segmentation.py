@@ -0,0 +1,626 @@
+"""
+Tests for src/lib/panel_segmentation.py on synthetic pages.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "lib"))
+
+import panel_segmentation as ps  # noqa: E402
+
+
+def draw_panel(im, rng, box, border=4):
+    """Draw a framed panel with random filled circles inside it as its art"""
+    x, y, w, h = box
+    cv2.rectangle(im, (x, y), (x + w - 1, y + h - 1), (0, 0, 0), border)
+    for _ in range(max(5, w * h // 20000)):
+        cx, cy = rng.integers(x + 45, x + w - 45), rng.integers(y + 45, y + h - 45)
+        gray = int(rng.integers(0, 200))
+        cv2.circle(im, (int(cx), int(cy)), int(rng.integers(5, 40)), (gray, gray, gray), -1)
+
+
+def grid_page(height, width, rows, cols, gutter=30, seed=0):
+    """A white page with a rows x cols grid of framed panels"""
+    rng = np.random.default_rng(seed)
+    im = np.full((height, width, 3), 255, np.uint8)
+    panel_h = (height - gutter * (rows + 1)) // rows
+    panel_w = (width - gutter * (cols + 1)) // cols
+    boxes = [(gutter + c * (panel_w + gutter), gutter + r * (panel_h + gutter), panel_w, panel_h)
+             for r in range(rows) for c in range(cols)]
+    for box in boxes:
+        draw_panel(im, rng, box)
+    return im, boxes
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    inter = max(0, min(ax + aw, bx + bw) - max(ax, bx)) * max(0, min(ay + ah, by + bh) - max(ay, by))
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def assert_matches(found, expected, min_iou=0.95):
+    assert len(found) == len(expected)
+    for box in expected:
+        assert max(iou(box, other) for other in found) >= min_iou, box
+
+
+def panel_boxes(result):
+    return [(p["boundingBox"]["x"], p["boundingBox"]["y"],
+             p["boundingBox"]["width"], p["boundingBox"]["height"]) for p in result["panels"]]
+
+
+# Reference implementations: the loops replaced by the vectorized code
+
+def nms_loop(boxes, threshold, existing=(), largest_first=True):
+    kept = []
+    reference = list(existing)
+    if largest_first:
+        boxes = sorted(boxes, key=lambda box: box[2] * box[3], reverse=True)
+    for x, y, w, h in boxes:
+        duplicate = False
+        for ex, ey, ew, eh in reference:
+            overlap_x = max(0, min(x + w, ex + ew) - max(x, ex))
+            overlap_y = max(0, min(y + h, ey + eh) - max(y, ey))
+            if overlap_x * overlap_y > w * h * threshold:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append((x, y, w, h))
+            reference.append((x, y, w, h))
+    return kept
+
+
+def band_cuts_loop(bounds, vertical_c_pos):
+    vertical_c_pos = [tuple(line) for line in vertical_c_pos]
+    for i, (x, top, bottom) in enumerate(vertical_c_pos):
+        for itr in range(len(bounds) - 1):
+            if bounds[itr] <= top < bounds[itr + 1]:
+                top = bounds[itr]
+            if bounds[itr] < bottom <= bounds[itr + 1]:
+                bottom = bounds[itr + 1]
+        vertical_c_pos[i] = (x, top, bottom)
+    return [sorted({x for x, top, bottom in vertical_c_pos if top <= lb and bottom >= ub})
+            for lb, ub in zip(bounds[:-1], bounds[1:])]
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_nms_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    count = int(rng.integers(0, 60))
+    boxes = [tuple(int(v) for v in box) for box in
+             np.column_stack([rng.integers(0, 900, (count, 2)), rng.integers(1, 300, (count, 2))])]
+    existing = [tuple(int(v) for v in box) for box in
+                np.column_stack([rng.integers(0, 900, (3, 2)), rng.integers(1, 300, (3, 2))])]
+    for threshold in (0.3, 0.5):
+        assert ps.suppress_overlapping_boxes(boxes, threshold) == nms_loop(boxes, threshold)
+        assert (ps.suppress_overlapping_boxes(boxes, threshold, existing, largest_first=False)
+                == nms_loop(boxes, threshold, existing, largest_first=False))
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_band_index_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    height = 3000
+    bounds = sorted({0, height - 1} | set(rng.integers(1, height - 1, int(rng.integers(0, 12))).tolist()))
+    count = int(rng.integers(0, 40))
+    ends = np.sort(rng.integers(0, height, (count, 2)), axis=1)
+    lines = np.column_stack([rng.integers(0, 2000, count), ends]).tolist()
+    assert ps.vertical_cuts_by_band(bounds, lines) == band_cuts_loop(bounds, lines)
+
+
+def test_grid_page():
+    im, boxes = grid_page(1800, 1200, 3, 2)
+    result = ps.segment_image(im, include_images=False)
+    assert result["detection"]["detector"] == "xyCut"
+    assert_matches(panel_boxes(result), boxes)
+    # Manga reading order: right panel first in every row
+    found = panel_boxes(result)
+    assert found[0][0] > found[1][0] and found[0][1] < found[2][1]
+
+
+def test_page_stream_matches_segment_image():
+    im, boxes = grid_page(1800, 1200, 3, 2)
+    options = {"include_images": False, "xy_cut": False, "preset": "fast"}
+    result = ps.segment_image(im, **options)
+    records = list(ps.iter_image_panels(im, **options))
+    assert records[0]["type"] == "page" and records[0]["detection"]["detector"] == "contour"
+    assert result["detection"]["detector"] == "contour"
+    assert panel_boxes({"panels": records[1:]}) == panel_boxes(result)
+    with pytest.raises(TypeError):
+        next(ps.iter_image_panels(im, include_image=False))
+
+
+@pytest.mark.parametrize("xy_cut", [True, False])
+def test_proxy_boxes_match_full_resolution(xy_cut):
+    # Frames thinner than a proxy pixel; refined edges must land where
+    # detection at full resolution puts them
+    im, boxes = grid_page(4800, 3200, 4, 3)
+    page = ps.PageContext(im)
+    full, full_detection = ps.detect_panel_boxes(page, config=ps.DetectionConfig(triage=False, xy_cut=xy_cut))
+    proxy, proxy_detection = ps.detect_panel_boxes(
+        page, config=ps.DetectionConfig(triage=False, xy_cut=xy_cut, detection_max_side=1000))
+    assert proxy_detection["detector"] == full_detection["detector"]
+    assert len(proxy) == len(full) == len(boxes)
+    for box in full:
+        nearest = min(proxy, key=lambda other: sum(abs(a - b) for a, b in zip(box, other)))
+        assert max(abs(a - b) for a, b in zip(box, nearest)) <= 1, (box, nearest)
+
+
+def yonkoma_page(cols, width, height, top=120, gutter=40, col_gap=80, side=60, seed=5):
+    """A 4-koma page with a title above each column and a page number"""
+    rng = np.random.default_rng(seed)
+    im = np.full((height, width, 3), 255, np.uint8)
+    col_w = (width - 2 * side - (cols - 1) * col_gap) // cols
+    panel_h = (height - top - 80 - 3 * gutter) // 4
+    boxes = []
+    for c in reversed(range(cols)):
+        x = side + c * (col_w + col_gap)
+        cv2.putText(im, "TITLE", (x + col_w // 3, top - 40), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+        for r in range(4):
+            box = (x, top + r * (panel_h + gutter), col_w, panel_h)
+            draw_panel(im, rng, box, border=3)
+            boxes.append(box)
+    cv2.putText(im, "12", (width // 2 - 20, height - 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+    return im, boxes
+
+
+@pytest.mark.parametrize("cols, width, height", [(1, 700, 2300), (2, 1400, 2000)])
+def test_yonkoma_page(cols, width, height):
+    im, boxes = yonkoma_page(cols, width, height)
+    result = ps.segment_image(im, include_images=False)
+    assert result["detection"]["detector"] == "yonkoma"
+    found = panel_boxes(result)
+    assert_matches(found, boxes, min_iou=0.9)
+    assert [box[1] for box in found[:4]] == sorted(box[1] for box in found[:4])
+    if cols == 2:
+        # Columns are read right to left
+        assert all(box[0] > width // 2 for box in found[:4])
+
+
+def test_spread_page():
+    left, left_boxes = grid_page(1800, 1200, 2, 2, seed=1)
+    right, right_boxes = grid_page(1800, 1200, 3, 2, seed=2)
+    im = np.hstack([left, right])
+    result = ps.segment_image(im, include_images=False)
+    assert result["detection"]["route"] == "spread"
+    found = panel_boxes(result)
+    right_boxes = [(x + 1200, y, w, h) for x, y, w, h in right_boxes]
+    assert_matches(found, left_boxes + right_boxes)
+    # The right-hand page is read first
+    assert all(box[0] >= 1200 for box in found[:len(right_boxes)])
+
+
+def strip_page(layout, width=800, seed=3):
+    """
+    A long webtoon strip: `layout` is a list of (top, height, split) rows,
+    each one full-width panel or a side-by-side pair when split
+    """
+    rng = np.random.default_rng(seed)
+    bottom = max(top + height for top, height, _ in layout)
+    im = np.full((bottom + 150, width, 3), 255, np.uint8)
+    boxes = []
+    for top, height, split in layout:
+        row = [(40, top, 340, height), (420, top, 340, height)] if split else [(40, top, 720, height)]
+        for box in row:
+            draw_panel(im, rng, box)
+        boxes += row[::-1]
+    return im, boxes
+
+
+def test_strip_page():
+    im, boxes = strip_page([(150, 900, False), (1350, 1400, False), (3000, 700, True),
+                            (4000, 2600, False), (6900, 500, False), (7700, 3400, False)])
+    assert ps.is_tall_strip(im)
+    result = ps.segment_image(im, include_images=False)
+    assert result["detection"]["route"] == "strip"
+    found = panel_boxes(result)
+    assert_matches(found, boxes)
+    assert [box[1] for box in found] == sorted(box[1] for box in found)
+
+    records = list(ps.iter_image_panels(im, include_images=False))
+    assert records[0]["type"] == "strip" and records[-1]["type"] == "end"
+    assert panel_boxes({"panels": records[1:-1]}) == found
+
+
+def test_flood_fill_finds_framed_panels():
+    im, boxes = grid_page(1800, 1200, 3, 2)
+    found, masks = ps.detect_panels_flood_fill(ps.PageContext(ps.apply_color_mode(im)), masks=True)
+    assert_matches(found, boxes)
+    assert [w * h for _, _, w, h in found] == sorted((w * h for _, _, w, h in found), reverse=True)
+    for (x, y, w, h), mask in zip(found, masks):
+        assert mask.shape == (h, w) and mask.mean() > 0.99
+
+
+def test_contour_detector_takes_flood_fill_panels():
+    # Panels too small to pass the edge method's filters away from the page
+    # edges are still holes of the gutter network
+    rng = np.random.default_rng(0)
+    im = np.full((1500, 1000, 3), 255, np.uint8)
+    boxes = [(170 + c * 230, 300 + r * 310, 200, 280) for r in range(3) for c in range(3)]
+    for box in boxes:
+        draw_panel(im, rng, box)
+    page = ps.PageContext(ps.apply_color_mode(im))
+    assert_matches(ps.detect_panels_contour_based(page), boxes, min_iou=0.9)
+    assert ps.detect_panels_contour_based(page, config=ps.DetectionConfig(flood_fill=False)) == []
+
+
+def test_xy_cut_speck_rows_are_blank():
+    # The frame's side columns count as black gutters, so its inside is cut
+    # out as a region whose two specks mark rows but no column
+    im = np.full((1400, 1000, 3), 255, np.uint8)
+    cv2.rectangle(im, (349, 0), (710, 1301), (0, 0, 0), 4)
+    im[730, 628] = 0
+    im[827, 637] = 0
+    assert ps.detect_panels_xy_cut(ps.PageContext(ps.apply_color_mode(im))) is None
+
+    ok, png = cv2.imencode(".png", im)
+    result = ps.segment_image_data(png.tobytes(), include_images=False)
+    assert "error" not in result
+    assert result["totalPanels"] >= 1
+
+
+def toned_page(height=3400, width=2400, rows=3, cols=2, gutter=12, seed=7):
+    """A grid page whose panels are filled with screentone, with thin gutters"""
+    rng = np.random.default_rng(seed)
+    im = np.full((height, width, 3), 255, np.uint8)
+    panel_h = (height - gutter * (rows + 1)) // rows
+    panel_w = (width - gutter * (cols + 1)) // cols
+    boxes = [(gutter + c * (panel_w + gutter), gutter + r * (panel_h + gutter), panel_w, panel_h)
+             for r in range(rows) for c in range(cols)]
+    for x, y, w, h in boxes:
+        im[y:y + h, x:x + w] = 150
+        im[y:y + h:6, x:x + w] = 60
+        draw_panel(im, rng, (x, y, w, h))
+    return im, boxes
+
+
+def test_triage_keeps_thin_gutters_on_toned_pages():
+    # A thumbnail averages 12px gutters into the tone around them
+    im, boxes = toned_page()
+    result = ps.segment_image(im, include_images=False)
+    assert result["detection"]["route"] == "gutters"
+    assert_matches(panel_boxes(result), boxes)
+
+
+def test_triage_routes_full_bleed_art_to_single():
+    rng = np.random.default_rng(11)
+    im = np.repeat(rng.integers(0, 180, (1800, 1200, 1), dtype=np.uint8), 3, axis=2)
+    result = ps.segment_image(im, include_images=False)
+    assert result["detection"]["route"] == "single"
+    assert panel_boxes(result) == [(0, 0, 1200, 1800)]
+
+
+def test_strip_panel_cut_by_tile_keeps_its_height():
+    # The pair is cut by tile edges; the contour detector finds the outlined
+    # circles inside its pieces, which must not stand in for the panels
+    im, boxes = strip_page([(150, 900, False), (1350, 1400, False), (3000, 700, True),
+                            (4000, 2600, False), (6900, 1500, False), (8700, 2000, True),
+                            (11000, 2800, False)])
+    for x in (40, 420):
+        for y in (9000, 9900, 10300):
+            cv2.circle(im, (x + 170, y), 101, (0, 0, 0), 3)
+    assert_matches(panel_boxes(ps.segment_image(im, include_images=False)), boxes)
+
+
+def test_fingerprint_covers_defaults_and_constants(monkeypatch):
+    baseline = ps.detection_fingerprint()
+    monkeypatch.setattr(ps, "_detection_fingerprint", None)
+    monkeypatch.setattr(ps._scaled_size, "__defaults__", (True,))
+    changed_default = ps.detection_fingerprint()
+    monkeypatch.setattr(ps, "_detection_fingerprint", None)
+    monkeypatch.setattr(ps._scaled_size, "__defaults__", (False,))
+    monkeypatch.setattr(ps, "STRIP_MIN_ASPECT", 4.0)
+    changed_constant = ps.detection_fingerprint()
+    monkeypatch.setattr(ps, "_detection_fingerprint", None)
+    monkeypatch.setattr(ps, "STRIP_MIN_ASPECT", 5.0)
+    monkeypatch.setattr(ps, "DEFAULT_CONFIG", ps.DetectionConfig(gutter_threshold=0.99))
+    changed_config = ps.detection_fingerprint()
+    assert len({baseline, changed_default, changed_constant, changed_config}) == 4
+
+
+def test_import_defers_server_modules():
+    script = ("import sys\n"
+              f"sys.path.insert(0, {os.path.dirname(ps.__file__)!r})\n"
+              "import panel_segmentation\n"
+              "print(sorted({'http.server', 'multiprocessing', 'subprocess', 'zipfile'} & set(sys.modules)))")
+    run = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    assert run.stdout.strip() == "[]"
+    assert issubclass(ps.SegmentationRequestHandler, ps.http_handler_class())
+
+
+def test_disk_cache_stores_json(tmp_path):
+    im, _ = grid_page(900, 600, 2, 2)
+    ok, png = cv2.imencode(".png", im)
+    cache = ps.SegmentationCache(disk_dir=str(tmp_path))
+    result = ps.segment_image_data(png.tobytes(), cache=cache, crop_encoding="raw")
+    files = list(tmp_path.rglob("*.json"))
+    assert len(files) == 1
+
+    fresh = ps.SegmentationCache(disk_dir=str(tmp_path))
+    assert ps.segment_image_data(png.tobytes(), cache=fresh, crop_encoding="raw") == result
+    assert fresh.stats()["diskHits"] == 1
+
+    # Anything but a JSON entry is a miss, never loaded
+    files[0].write_bytes(b"\x80\x04garbage")
+    fresh = ps.SegmentationCache(disk_dir=str(tmp_path))
+    assert fresh.get(files[0].stem) is None
+
+
+def test_cache_key_normalises_options():
+    cache = ps.SegmentationCache()
+    key = cache.key(b"page")
+    assert cache.key(b"page", {"preset": "balanced", "xy_cut": True, "include_images": True,
+                               "tile_height": None, "encode_workers": 4}) == key
+    assert cache.key(b"page", {"config": {"canny_low": 80}}) == key
+    assert cache.key(b"page", {"preset": "fast"}) == cache.key(b"page", {"config": ps.PRESETS["fast"]})
+    assert cache.key(b"page", {"xy_cut": False}) != key
+    assert cache.key(b"page", {"include_images": False}) != key
+
+
+def test_cache_memory_tier_keeps_its_byte_budget():
+    result = {"panels": [{"id": 1, "imageData": "x" * 100}]}
+    size = len(ps.SegmentationCache._dumps(result))
+    cache = ps.SegmentationCache(memory_bytes=2 * size)
+    for key in "abc":
+        cache.put(key, result)
+    stats = cache.stats()
+    assert stats["memory"]["entries"] == 2 and stats["memory"]["bytes"] <= 2 * size
+    assert stats["evictions"] == 1
+    # The least recently used entry goes first
+    assert cache.get("a") is None and cache.get("c") == result
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    result = {"panels": [{"id": 1, "imageData": "x" * 100}]}
+    size = len(ps.SegmentationCache._dumps(result))
+    cache = ps.SegmentationCache(memory_bytes=0, disk_dir=str(tmp_path), disk_bytes=2 * size)
+    for age, key in enumerate(("aa", "bb")):
+        cache.put(key, result)
+        os.utime(cache._disk_path(key), (age, age))
+    # Reading an entry refreshes it, so "bb" is now the oldest
+    assert cache.get("aa") == result
+    cache.put("cc", result)
+    assert sorted(path.stem for path in tmp_path.rglob("*.json")) == ["aa", "cc"]
+    assert cache.stats()["disk"]["bytes"] <= 2 * size
+
+
+def test_detection_flags_map_to_segment_options():
+    parser = argparse.ArgumentParser()
+    ps.add_detection_arguments(parser)
+    options = ps.detection_options(parser.parse_args([]))
+    ps.check_segment_options(options)
+    assert options["preset"] == "balanced" and options["xy_cut"] is None and options["spread"] == "auto"
+    options = ps.detection_options(parser.parse_args(["--no-xy-cut", "--keep-color", "--yonkoma", "never",
+                                                      "--spread", "always", "--detect-max-side", "800"]))
+    ps.check_segment_options(options)
+    assert (options["xy_cut"], options["grayscale"], options["yonkoma"], options["spread"],
+            options["detection_max_side"]) == (False, False, False, True, 800)
+
+
+@pytest.fixture
+def http_server():
+    pool = multiprocessing.Pool(processes=1)
+    handler = type("Handler", (ps.SegmentationRequestHandler,), {"pool": pool, "workers": 1, "cache": None})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/segment"
+    server.shutdown()
+    pool.terminate()
+
+
+def post(url, body, content_type="application/json"):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_http_rejects_malformed_requests(http_server):
+    im, boxes = grid_page(900, 600, 2, 2)
+    image = base64.b64encode(cv2.imencode(".png", im)[1].tobytes()).decode()
+    for payload in ({"imageBase64": image, "options": "x"},
+                    {"imageBase64": 5},
+                    {"imageBase64": image, "options": {"bogus": 1}},
+                    {"imageBase64": base64.b64encode(b"not an image").decode()},
+                    {"imageBase64": image, "options": {"crop_encoding": "raw"}},
+                    {"imageBase64": image, "options": {"preset": "bogus"}},
+                    {"imageBase64": image, "options": {"time_budget_ms": "x"}},
+                    {"imageBase64": image, "options": {"config": {"nope": 1}}},
+                    {"imageBase64": image, "options": {"config": {"min_side": "x"}}},
+                    {"imageBase64": image, "options": {"encode_workers": "a"}},
+                    {"imageBase64": image, "options": {"line_engine": "zzz"}},
+                    {"imageBase64": image, "options": {"include_images": 0}},
+                    [1]):
+        status, result = post(http_server, json.dumps(payload).encode())
+        assert status == 400 and result["error"], payload
+    assert post(http_server, b"not an image", "application/octet-stream")[0] == 400
+    status, result = post(http_server + "?line_engine=zzz", b"not an image", "application/octet-stream")
+    assert status == 400 and "line engine" in result["error"]
+
+    host, port = urllib.parse.urlsplit(http_server).netloc.split(":")
+    with socket.create_connection((host, int(port)), timeout=60) as connection:
+        connection.sendall(b"POST /segment HTTP/1.1\r\nHost: x\r\nContent-Length: abc\r\n\r\n")
+        assert connection.recv(1024).startswith(b"HTTP/1.1 400")
+
+    status, result = post(http_server, json.dumps({"imageBase64": image,
+                                                   "options": {"include_images": False}}).encode())
+    assert status == 200
+    assert_matches(panel_boxes(result), boxes)
+
+
+def test_binary_result_round_trip():
+    im, boxes = grid_page(900, 600, 2, 2)
+    raw = ps.segment_image(im, crop_encoding="raw")
+    decoded = ps.decode_binary_result(ps.encode_binary_result(raw))
+    assert decoded == ps.compact_result(raw)
+    assert all(crop.startswith(b"\xff\xd8") for crop in decoded["images"])
+    # Base64 crops are framed as the same raw bytes
+    encoded = ps.segment_image(im)
+    assert ps.decode_binary_result(ps.format_result(encoded, "binary"))["images"] == decoded["images"]
+
+    boxes_only = ps.segment_image(im, include_images=False)
+    decoded = ps.decode_binary_result(memoryview(ps.encode_binary_result(boxes_only)))
+    assert decoded == ps.compact_result(boxes_only) and "images" not in decoded
+
+
+def test_worker_rejects_raw_crop_encoding():
+    # Raw crop bytes can't be written as a JSON line
+    im, _ = grid_page(900, 600, 2, 2)
+    image = base64.b64encode(cv2.imencode(".png", im)[1].tobytes()).decode()
+    request = {"id": 1, "image": image, "options": {"crop_encoding": "raw"}}
+    assert ps.handle_request(request)["error"]
+    assert [response.get("error") for response in ps.stream_request(dict(request, stream=True))][0]
+
+
+def serve_lines(requests, **options):
+    """Run the stdio worker over `requests` and parse the lines it writes"""
+    output = io.StringIO()
+    lines = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in requests)
+    ps.serve_stdio(input_stream=io.StringIO(lines + "\n"), output_stream=output, **options)
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_stdio_worker_answers_every_request():
+    im, boxes = grid_page(900, 600, 2, 2)
+    image = base64.b64encode(cv2.imencode(".png", im)[1].tobytes()).decode()
+    responses = serve_lines([{"id": 1, "image": image, "options": {"include_images": False}},
+                             {"id": 2, "image": image, "stream": True, "options": {"include_images": False}},
+                             {"id": 3, "image": "bm90IGFuIGltYWdl"},
+                             "{not json"], output_format="compact")
+    assert responses[0]["ready"]
+    by_id = {}
+    for response in responses[1:]:
+        by_id.setdefault(response["id"], []).append(response)
+    assert_matches([tuple(box) for box in by_id[1][0]["result"]["boxes"]], boxes)
+    records = [response["record"] for response in by_id[2] if "record" in response]
+    assert records[0]["type"] == "page" and by_id[2][-1]["done"]
+    assert_matches([tuple(record["boundingBox"][key] for key in ("x", "y", "width", "height"))
+                    for record in records if record["type"] == "panel"], boxes)
+    assert by_id[3][0]["error"] and by_id[None][0]["error"]
+
+
+@pytest.fixture
+def shared_page():
+    """A grid page PNG in a shared-memory segment with spare bytes after it"""
+    im, boxes = grid_page(900, 600, 2, 2)
+    png = cv2.imencode(".png", im)[1].tobytes()
+    segment = shared_memory.SharedMemory(create=True, size=len(png) + 4096)
+    segment.buf[:len(png)] = png
+    yield segment, len(png), png, boxes
+    segment.close()
+    segment.unlink()
+
+
+def run_cli(*args, stdin=b""):
+    """Run the CLI in a fresh process, as the Node service does, returning its stdout"""
+    run = subprocess.run([sys.executable, ps.__file__, "--no-cache", *args],
+                         input=stdin, capture_output=True, timeout=120)
+    return run.stdout.decode()
+
+
+def test_cli_reads_binary_stdin_and_shared_memory(shared_page):
+    segment, size, png, boxes = shared_page
+    frame = struct.pack(">I", len(png)) + png
+    assert_matches(panel_boxes(json.loads(run_cli("--boxes-only", "--stdin-binary", stdin=frame))), boxes)
+    result = json.loads(run_cli("--boxes-only", "--shm", segment.name, "--shm-size", str(size)))
+    assert_matches(panel_boxes(result), boxes)
+    # A truncated frame is reported rather than segmented
+    assert json.loads(run_cli("--stdin-binary", stdin=frame[:100]))["error"]
+
+
+def test_stdio_worker_reads_paths_and_shared_memory(tmp_path, shared_page):
+    segment, size, png, boxes = shared_page
+    (tmp_path / "page.png").write_bytes(png)
+    requests = [{"id": 1, "path": str(tmp_path / "page.png"), "options": {"include_images": False}},
+                {"id": 2, "shm": segment.name, "shmSize": size, "options": {"include_images": False}},
+                {"id": 3, "path": str(tmp_path / "missing.png")}]
+    output = run_cli("--serve-stdio", stdin="".join(json.dumps(request) + "\n" for request in requests).encode())
+    by_id = {response.get("id"): response for response in map(json.loads, output.splitlines())}
+    for request_id in (1, 2):
+        assert_matches(panel_boxes(by_id[request_id]["result"]), boxes)
+    assert by_id[3]["error"]
+    # The producer still owns the segment
+    assert bytes(segment.buf[:size]) == png
+
+
+def test_stdio_worker_reports_a_failed_stream(monkeypatch):
+    def failing_stream(request):
+        yield {"id": request["id"], "record": {"type": "page"}}
+        raise RuntimeError("encoder crashed")
+
+    monkeypatch.setattr(ps, "stream_request", failing_stream)
+    responses = serve_lines([{"id": 3, "image": "", "stream": True}])
+    assert responses[1:] == [{"id": 3, "record": {"type": "page"}}, {"id": 3, "error": "encoder crashed"}]
+
+
+def test_benchmark_skips_undecodable_pages(tmp_path):
+    im, _ = grid_page(900, 600, 2, 2)
+    cv2.imwrite(str(tmp_path / "001.png"), im)
+    (tmp_path / "002.png").write_bytes(b"not an image")
+    report = ps.benchmark_line_engines(str(tmp_path), repeat=1)
+    assert report["pages"] == 1
+    assert [page["name"] for page in report["skipped"]] == ["002.png"]
+    assert set(report["engines"]) == set(ps.LINE_ENGINES)
+
+
+
+
+def cross_page():
+    """A white page split into four by two full-length lines, which closes
+    no contour for the edge method"""
+    im = np.full((1500, 1000, 3), 255, np.uint8)
+    cv2.line(im, (0, 700), (999, 700), (0, 0, 0), 3)
+    cv2.line(im, (500, 0), (500, 1499), (0, 0, 0), 3)
+    return im
+
+
+def test_contour_steps_fit_the_time_budget(monkeypatch):
+    # Canny can't stop midway, so a step whose cost doesn't fit is skipped
+    # up front rather than overrunning the budget
+    monkeypatch.setitem(ps.CONTOUR_STEP_COST, "edges", 1e9)
+    config = ps.resolve_config(triage=False, xy_cut=False, line_fallback=False)
+    im, _ = grid_page(900, 600, 2, 2)
+    detection = ps.segment_image(im, include_images=False, time_budget_ms=60000, config=config)["detection"]
+    assert detection["partial"] and detection["stage"] == "contour" and detection["detector"] == "page"
+
+
+def test_skipped_step_leaves_the_budget_to_later_stages(monkeypatch):
+    deadline = ps.Deadline(1000)
+    assert not deadline.fits(5000)
+    assert deadline.hit and not deadline.expired() and deadline.fits(1)
+
+    # A flood fill too costly for the budget still leaves the sweep and the
+    # line fallback their turn
+    monkeypatch.setitem(ps.CONTOUR_STEP_COST, "floodFill", 1e9)
+    thresholds = []
+    adaptive_threshold = cv2.adaptiveThreshold
+    monkeypatch.setattr(ps.cv2, "adaptiveThreshold",
+                        lambda *args: thresholds.append(args) or adaptive_threshold(*args))
+    config = ps.resolve_config(triage=False, xy_cut=False)
+    result = ps.segment_image(cross_page(), include_images=False, time_budget_ms=60000, config=config)
+    assert thresholds
+    assert result["detection"]["partial"] and result["detection"]["stage"] == "lines"
+    assert result["totalPanels"] == 4